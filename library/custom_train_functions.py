@@ -5,17 +5,21 @@ from typing import List, Optional, Union
 
 
 def apply_snr_weight(loss, timesteps, noise_scheduler, gamma):
+    snr_weight = get_snr_weights(noise_scheduler, gamma).to(loss.device)[timesteps]
+    loss = loss * snr_weight
+    return loss
+
+
+def get_snr_weights(noise_scheduler, gamma):
+    # 全timestep分のmin-SNRの重み。timestepsでindexすればbatchのsnr_weightになる
     alphas_cumprod = noise_scheduler.alphas_cumprod
     sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
     sqrt_one_minus_alphas_cumprod = torch.sqrt(1.0 - alphas_cumprod)
     alpha = sqrt_alphas_cumprod
     sigma = sqrt_one_minus_alphas_cumprod
     all_snr = (alpha / sigma) ** 2
-    snr = torch.stack([all_snr[t] for t in timesteps])
-    gamma_over_snr = torch.div(torch.ones_like(snr) * gamma, snr)
-    snr_weight = torch.minimum(gamma_over_snr, torch.ones_like(gamma_over_snr)).float()  # from paper
-    loss = loss * snr_weight
-    return loss
+    gamma_over_snr = torch.div(torch.ones_like(all_snr) * gamma, all_snr)
+    return torch.minimum(gamma_over_snr, torch.ones_like(gamma_over_snr)).float()  # from paper
 
 
 def add_custom_train_arguments(parser: argparse.ArgumentParser, support_weighted_captions: bool = True):
@@ -74,6 +74,9 @@ LAST_STATE_NAME = "{}-state"
 DEFAULT_EPOCH_NAME = "epoch"
 DEFAULT_LAST_OUTPUT_NAME = "last"
 
+# latentのディスクキャッシュの形式が変わったら上げる（古いキャッシュは使われなくなる）
+LATENTS_CACHE_VERSION = 1
+
 # region dataset
 
 IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg", ".webp", ".bmp", ".PNG", ".JPG", ".JPEG", ".WEBP", ".BMP"]
@@ -440,6 +443,7 @@ class BaseDataset(torch.utils.data.Dataset):
         self.image_to_subset: Dict[str, Union[DreamBoothSubset, FineTuningSubset]] = {}
 
         self.replacements = {}
+        self.input_ids_cache = {}
 
     def set_seed(self, seed):
         self.seed = seed
@@ -476,6 +480,11 @@ class BaseDataset(torch.utils.data.Dataset):
     def add_replacement(self, str_from, str_to):
         self.replacements[str_from] = str_to
 
+    def cache_input_ids(self, captions):
+        # 固定のキャプション（textual inversionのテンプレートなど）は事前にtokenizeしておき、毎回のtokenizeを省く
+        for caption in captions:
+            self.input_ids_cache[caption] = self.get_input_ids(caption)
+
     def process_caption(self, subset: BaseSubset, caption):
         # dropoutの決定：tag dropがこのメソッド内にあるのでここで行うのが良い
         is_drop_out = subset.caption_dropout_rate > 0 and random.random() < subset.caption_dropout_rate
@@ -525,7 +534,7 @@ class BaseDataset(torch.utils.data.Dataset):
             for str_from, str_to in self.replacements.items():
                 if str_from == "":
                     # replace all
-                    if type(str_to) == list:
+                    if isinstance(str_to, (list, tuple)):
                         caption = random.choice(str_to)
                     else:
                         caption = str_to
@@ -535,6 +544,9 @@ class BaseDataset(torch.utils.data.Dataset):
         return caption
 
     def get_input_ids(self, caption):
+        if isinstance(caption, str) and caption in self.input_ids_cache:
+            return self.input_ids_cache[caption]
+
         input_ids = self.tokenizer(
             caption, padding="max_length", truncation=True, max_length=self.tokenizer_max_length, return_tensors="pt"
         ).input_ids
@@ -722,8 +734,10 @@ class BaseDataset(torch.utils.data.Dataset):
     def is_latent_cacheable(self):
         return all([not subset.color_aug and not subset.random_crop for subset in self.subsets])
 
-    def cache_latents(self, vae, vae_batch_size=1):
+    def cache_latents(self, vae, vae_batch_size=1, cache_dir=None, cache_id=""):
         # ちょっと速くした
+        # cache_dirが指定されていればlatentをディスクにもキャッシュし、次回以降はVAEでのencodeを省く
+        # cache_idはVAEのモデルなど、画像以外でlatentが変わる要素を識別する文字列
         print("caching latents.")
 
         image_infos = list(self.image_data.values())
@@ -745,6 +759,12 @@ class BaseDataset(torch.utils.data.Dataset):
                     info.latents_flipped = torch.FloatTensor(info.latents_flipped)
                 continue
 
+            if cache_dir is not None:
+                cache_file = self.get_latents_cache_file(cache_dir, cache_id, info, subset.flip_aug)
+                if os.path.exists(cache_file):
+                    self.load_latents_from_cache_file(info, cache_file)
+                    continue
+
             # if last member of batch has different resolution, flush the batch
             if len(batch) > 0 and batch[-1].bucket_reso != info.bucket_reso:
                 batches.append(batch)
@@ -782,6 +802,12 @@ class BaseDataset(torch.utils.data.Dataset):
                 for info, latent in zip(batch, latents):
                     info.latents_flipped = latent
 
+            if cache_dir is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                for info in batch:
+                    flip_aug = self.image_to_subset[info.image_key].flip_aug
+                    self.save_latents_to_cache_file(info, self.get_latents_cache_file(cache_dir, cache_id, info, flip_aug))
+
     def get_image_size(self, image_path):
         image = Image.open(image_path)
         return image.size
@@ -847,6 +873,37 @@ class BaseDataset(torch.utils.data.Dataset):
 
         return image
 
+    def get_latents_cache_file(self, cache_dir, cache_id, image_info: ImageInfo, flip_aug):
+        # 画像ファイルが更新されたり解像度が変わったりしたら別のファイルになるようにする
+        stat = os.stat(image_info.absolute_path)
+        key = "|".join(
+            [
+                str(LATENTS_CACHE_VERSION),
+                cache_id,
+                os.path.abspath(image_info.absolute_path),
+                str(stat.st_mtime_ns),
+                str(stat.st_size),
+                str(image_info.bucket_reso),
+                str(image_info.resized_size),
+                str(flip_aug),
+            ]
+        )
+        return os.path.join(cache_dir, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".safetensors")
+
+    def load_latents_from_cache_file(self, image_info: ImageInfo, cache_file):
+        latents = safetensors.torch.load_file(cache_file)  # loaded into CPU memory
+        image_info.latents = latents["latents"]
+        image_info.latents_flipped = latents.get("latents_flipped")
+
+    def save_latents_to_cache_file(self, image_info: ImageInfo, cache_file):
+        latents = {"latents": image_info.latents.contiguous()}
+        if image_info.latents_flipped is not None:
+            latents["latents_flipped"] = image_info.latents_flipped.contiguous()
+        # 中断されても書きかけのファイルが残らないよう、一時ファイルに書いてからrenameする
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        safetensors.torch.save_file(latents, tmp_file)
+        os.replace(tmp_file, cache_file)
+
     def load_latents_from_npz(self, image_info: ImageInfo, flipped):
         npz_file = image_info.latents_npz_flipped if flipped else image_info.latents_npz
         if npz_file is None:
@@ -1332,6 +1389,10 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
         for dataset in self.datasets:
             dataset.add_replacement(str_from, str_to)
 
+    def cache_input_ids(self, captions):
+        for dataset in self.datasets:
+            dataset.cache_input_ids(captions)
+
     # def make_buckets(self):
     #   for dataset in self.datasets:
     #     dataset.make_buckets()
@@ -1340,10 +1401,10 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
         for dataset in self.datasets:
             dataset.enable_XTI(*args, **kwargs)
 
-    def cache_latents(self, vae, vae_batch_size=1):
+    def cache_latents(self, vae, vae_batch_size=1, cache_dir=None, cache_id=""):
         for i, dataset in enumerate(self.datasets):
             print(f"[Dataset {i}]")
-            dataset.cache_latents(vae, vae_batch_size)
+            dataset.cache_latents(vae, vae_batch_size, cache_dir, cache_id)
 
     def is_latent_cacheable(self) -> bool:
         return all([dataset.is_latent_cacheable() for dataset in self.datasets])
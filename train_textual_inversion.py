@@ -1,10 +1,12 @@
 import importlib
 import argparse
+import concurrent.futures
+import functools
 import gc
 import math
 import os
 import toml
-from multiprocessing import Value
+from multiprocessing import RawValue
 
 from tqdm import tqdm
 import torch
@@ -20,9 +22,9 @@ from library.config_util import (
     BlueprintGenerator,
 )
 import library.custom_train_functions as custom_train_functions
-from library.custom_train_functions import apply_snr_weight
+from library.custom_train_functions import get_snr_weights
 
-imagenet_templates_small = [
+imagenet_templates_small = (
     "a photo of a {}",
     "a rendering of a {}",
     "a cropped photo of the {}",
@@ -50,9 +52,9 @@ imagenet_templates_small = [
     "a photo of the large {}",
     "a photo of a cool {}",
     "a photo of a small {}",
-]
+)
 
-imagenet_style_templates_small = [
+imagenet_style_templates_small = (
     "a painting in the style of {}",
     "a rendering in the style of {}",
     "a cropped painting in the style of {}",
@@ -72,7 +74,13 @@ imagenet_style_templates_small = [
     "a small painting in the style of {}",
     "a weird painting in the style of {}",
     "a large painting in the style of {}",
-]
+)
+
+
+@functools.lru_cache(maxsize=8)
+def expand_templates(replace_to: str, style: bool):
+    templates = imagenet_style_templates_small if style else imagenet_templates_small
+    return tuple(tmpl.format(replace_to) for tmpl in templates)
 
 
 def train(args):
@@ -83,7 +91,7 @@ def train(args):
     train_util.verify_training_args(args)
     train_util.prepare_dataset_args(args, True)
 
-    cache_latents = args.cache_latents
+    cache_latents = args.cache_latents or args.cache_latents_to_disk  # ディスクへのキャッシュはcache_latentsを含む
 
     if args.seed is not None:
         set_seed(args.seed)
@@ -119,7 +127,7 @@ def train(args):
 
     token_ids = tokenizer.convert_tokens_to_ids(token_strings)
     print(f"tokens are added: {token_ids}")
-    assert min(token_ids) == token_ids[0] and token_ids[-1] == token_ids[0] + len(token_ids) - 1, f"token ids is not ordered"
+    assert token_ids == list(range(token_ids[0], token_ids[0] + len(token_ids))), f"token ids is not ordered"
     assert len(tokenizer) - 1 == token_ids[-1], f"token ids is not end of tokenize: {len(tokenizer)}"
 
     # Resize the token embeddings as we are adding new special tokens to the tokenizer
@@ -127,10 +135,10 @@ def train(args):
 
     # Initialise the newly added placeholder token with the embeddings of the initializer token
     token_embeds = text_encoder.get_input_embeddings().weight.data
+    token_ids_t = torch.tensor(token_ids, device=token_embeds.device)
     if init_token_ids is not None:
-        for i, token_id in enumerate(token_ids):
-            token_embeds[token_id] = token_embeds[init_token_ids[i % len(init_token_ids)]]
-            # print(token_id, token_embeds[token_id].mean(), token_embeds[token_id].min())
+        src_ids = torch.tensor([init_token_ids[i % len(init_token_ids)] for i in range(len(token_ids))], device=token_embeds.device)
+        token_embeds.index_copy_(0, token_ids_t, token_embeds[src_ids])
 
     # load weights
     if args.weights is not None:
@@ -139,9 +147,7 @@ def train(args):
             embeddings
         ), f"num_vectors_per_token is mismatch for weights / 指定した重みとnum_vectors_per_tokenの値が異なります: {len(embeddings)}"
         # print(token_ids, embeddings.size())
-        for token_id, embedding in zip(token_ids, embeddings):
-            token_embeds[token_id] = embedding
-            # print(token_id, token_embeds[token_id].mean(), token_embeds[token_id].min())
+        token_embeds.index_copy_(0, token_ids_t, embeddings.to(token_embeds.device, dtype=token_embeds.dtype))
         print(f"weighs loaded")
 
     print(f"create embeddings for {args.num_vectors_per_token} tokens, for {args.token_string}")
@@ -185,20 +191,24 @@ def train(args):
     blueprint = blueprint_generator.generate(user_config, args, tokenizer=tokenizer)
     train_dataset_group = config_util.generate_dataset_group_by_blueprint(blueprint.dataset_group)
 
-    current_epoch = Value('i',0)
-    current_step = Value('i',0)
-    ds_for_collater = train_dataset_group if args.max_data_loader_n_workers == 0 else None
+    # 書き込みはメインプロセスのみなのでlockは不要
+    current_epoch = RawValue("i", 0)
+    current_step = RawValue("i", 0)
+
+    # DataLoaderのプロセス数：0はメインプロセスになる
+    # 使用可能なCPU数はaffinityで制限されていることがあるので、可能ならcpu_countではなくそちらを使う
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    n_workers = min(args.max_data_loader_n_workers, n_cpus - 1)  # cpu_count-1 ただし最大で指定された数まで
+    ds_for_collater = train_dataset_group if n_workers == 0 else None
     collater = train_util.collater_class(current_epoch,current_step, ds_for_collater)
 
     # make captions: tokenstring tokenstring1 tokenstring2 ...tokenstringn という文字列に書き換える超乱暴な実装
     if use_template:
         print("use template for training captions. is object: {args.use_object_template}")
-        templates = imagenet_templates_small if args.use_object_template else imagenet_style_templates_small
         replace_to = " ".join(token_strings)
-        captions = []
-        for tmpl in templates:
-            captions.append(tmpl.format(replace_to))
+        captions = expand_templates(replace_to, not args.use_object_template)
         train_dataset_group.add_replacement("", captions)
+        train_dataset_group.cache_input_ids(captions)
 
         if args.num_vectors_per_token > 1:
             prompt_replacement = (args.token_string, replace_to)
@@ -232,8 +242,21 @@ def train(args):
         vae.to(accelerator.device, dtype=weight_dtype)
         vae.requires_grad_(False)
         vae.eval()
+        if args.cache_latents_to_disk:
+            latents_cache_dir = os.path.join(args.output_dir, ".latents_cache")
+            latents_cache_id = f"{args.pretrained_model_name_or_path}|{args.vae}|{weight_dtype}"
+        else:
+            latents_cache_dir, latents_cache_id = None, ""
         with torch.no_grad():
-            train_dataset_group.cache_latents(vae, args.vae_batch_size)
+            if latents_cache_dir is None:
+                train_dataset_group.cache_latents(vae, args.vae_batch_size)
+            else:
+                # メインプロセスがキャッシュを作成し、他のプロセスはそれを読み込む
+                if accelerator.is_main_process:
+                    train_dataset_group.cache_latents(vae, args.vae_batch_size, latents_cache_dir, latents_cache_id)
+                accelerator.wait_for_everyone()
+                if not accelerator.is_main_process:
+                    train_dataset_group.cache_latents(vae, args.vae_batch_size, latents_cache_dir, latents_cache_id)
         vae.to("cpu")
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
@@ -245,12 +268,20 @@ def train(args):
 
     # 学習に必要なクラスを準備する
     print("prepare optimizer, data loader etc.")
-    trainable_params = text_encoder.get_input_embeddings().parameters()
+    trained_embeds = patch_token_embedding(text_encoder.get_input_embeddings(), token_ids)
+
+    # Freeze all parameters except for the embeddings of the added tokens in text encoder
+    text_encoder.requires_grad_(False)
+    trained_embeds.requires_grad_(True)
+
+    trainable_params = [trained_embeds]
     _, _, optimizer = train_util.get_optimizer(args, trainable_params)
 
     # dataloaderを準備する
-    # DataLoaderのプロセス数：0はメインプロセスになる
-    n_workers = min(args.max_data_loader_n_workers, os.cpu_count() - 1)  # cpu_count-1 ただし最大で指定された数まで
+    # prefetch_factorはworkerがある場合のみ指定できる
+    loader_kwargs = {"prefetch_factor": args.dataloader_prefetch_factor} if n_workers > 0 else {}
+    # pinするとGPUへの転送が速くなる。workerがない場合はメインスレッドでのコピーが増えるだけなので行わない
+    pin_memory = torch.cuda.is_available() and n_workers > 0
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset_group,
         batch_size=1,
@@ -258,6 +289,8 @@ def train(args):
         collate_fn=collater,
         num_workers=n_workers,
         persistent_workers=args.persistent_data_loader_workers,
+        pin_memory=pin_memory,
+        **loader_kwargs,
     )
 
     # 学習ステップ数を計算する
@@ -276,17 +309,6 @@ def train(args):
         text_encoder, optimizer, train_dataloader, lr_scheduler
     )
 
-    index_no_updates = torch.arange(len(tokenizer)) < token_ids[0]
-    # print(len(index_no_updates), torch.sum(index_no_updates))
-    orig_embeds_params = unwrap_model(text_encoder).get_input_embeddings().weight.data.detach().clone()
-
-    # Freeze all parameters except for the token embeddings in text encoder
-    text_encoder.requires_grad_(True)
-    text_encoder.text_model.encoder.requires_grad_(False)
-    text_encoder.text_model.final_layer_norm.requires_grad_(False)
-    text_encoder.text_model.embeddings.position_embedding.requires_grad_(False)
-    # text_encoder.text_model.embeddings.token_embedding.requires_grad_(True)
-
     unet.requires_grad_(False)
     unet.to(accelerator.device, dtype=weight_dtype)
     if args.gradient_checkpointing:  # according to TI example in Diffusers, train is required
@@ -304,8 +326,25 @@ def train(args):
         train_util.patch_accelerator_for_fp16_training(accelerator)
         text_encoder.to(weight_dtype)
 
+    # noiseとtimestepsは専用のgeneratorで学習デバイス上に生成する（seed指定時は再現性がある）
+    generator = torch.Generator(device=accelerator.device)
+    if args.seed is not None:
+        generator.manual_seed(args.seed)
+    else:
+        generator.seed()
+    # stateと一緒に保存し、resume時に復元する
+    accelerator.register_for_checkpointing(GeneratorState(generator))
+
     # resumeする
-    train_util.resume_from_local_or_hf_if_specified(accelerator, args)
+    try:
+        train_util.resume_from_local_or_hf_if_specified(accelerator, args)
+    except RuntimeError as e:
+        # 追加トークンを別のパラメータで学習する前のstateは読み込めない
+        if "trained_embeds" in str(e):
+            raise RuntimeError(
+                "this state was saved by an older version and cannot be resumed, use --weights instead / 古いバージョンで保存されたstateのためresumeできません。代わりに--weightsを使ってください"
+            ) from e
+        raise
 
     # epoch数を計算する
     num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
@@ -331,20 +370,47 @@ def train(args):
     noise_scheduler = DDPMScheduler(
         beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", num_train_timesteps=1000, clip_sample=False
     )
+    # add_noise/get_velocityの係数を事前にデバイス上に用意しておく
+    sqrt_alphas_cumprod = noise_scheduler.alphas_cumprod.sqrt().to(accelerator.device)
+    sqrt_one_minus_alphas_cumprod = (1.0 - noise_scheduler.alphas_cumprod).sqrt().to(accelerator.device)
+    snr_weights = get_snr_weights(noise_scheduler, args.min_snr_gamma).to(accelerator.device) if args.min_snr_gamma else None
 
     if accelerator.is_main_process:
         accelerator.init_trackers("textual_inversion")
 
+    # 拡散過程とlossの計算はpointwiseな演算が多いので、指定があればtorch.compileでfuseする
+    forward_diffusion_fn = forward_diffusion
+    weighted_mse_loss_fn = weighted_mse_loss
+    if args.torch_compile:
+        if hasattr(torch, "compile"):
+            # bucketごとにshapeは固定なのでstatic shapeでcompileする
+            forward_diffusion_fn = torch.compile(forward_diffusion, dynamic=False)
+            weighted_mse_loss_fn = torch.compile(weighted_mse_loss, dynamic=False)
+        else:
+            print("torch.compile is not available in this version of PyTorch, ignore --torch_compile / このバージョンのPyTorchではtorch.compileが使えないため無視します")
+
+    params_to_clip = [trained_embeds]
+
+    # noiseのバッファを使い回す（bucketが変わったら作り直す）
+    noise_buf = None
+    noise_offset_buf = None
+
+    # --async_upload: 1つのスレッドで順番にアップロードする
+    if args.huggingface_repo_id is not None and args.async_upload:
+        upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    else:
+        upload_executor = None
+    upload_futures = {}  # checkpoint file -> pending upload
+
     for epoch in range(num_train_epochs):
         print(f"epoch {epoch+1}/{num_train_epochs}")
         current_epoch.value = epoch+1
 
         text_encoder.train()
 
-        loss_total = 0
+        loss_total = torch.zeros((), device=accelerator.device)  # 毎stepの同期を避けるためデバイス上で合計する
 
         for step, batch in enumerate(train_dataloader):
-            current_step.value = global_step
             with accelerator.accumulate(text_encoder):
                 with torch.no_grad():
                     if "latents" in batch and batch["latents"] is not None:
@@ -361,87 +427,87 @@ def train(args):
                 encoder_hidden_states = train_util.get_hidden_states(args, input_ids, tokenizer, text_encoder, torch.float)
 
                 # Sample noise that we'll add to the latents
-                noise = torch.randn_like(latents, device=latents.device)
+                if noise_buf is None or noise_buf.shape != latents.shape or noise_buf.dtype != latents.dtype:
+                    noise_buf = torch.empty_like(latents)
+                noise = torch.randn(latents.shape, out=noise_buf, generator=generator)
                 if args.noise_offset:
                     # https://www.crosslabs.org//blog/diffusion-with-offset-noise
-                    noise += args.noise_offset * torch.randn((latents.shape[0], latents.shape[1], 1, 1), device=latents.device)
+                    offset_shape = (latents.shape[0], latents.shape[1], 1, 1)
+                    if noise_offset_buf is None or noise_offset_buf.shape != offset_shape or noise_offset_buf.dtype != latents.dtype:
+                        noise_offset_buf = latents.new_empty(offset_shape)
+                    noise += args.noise_offset * torch.randn(offset_shape, out=noise_offset_buf, generator=generator)
 
                 # Sample a random timestep for each image
-                timesteps = torch.randint(0, noise_scheduler.config.num_train_timesteps, (b_size,), device=latents.device)
-                timesteps = timesteps.long()
+                timesteps = torch.randint(
+                    0, noise_scheduler.config.num_train_timesteps, (b_size,), device=latents.device, generator=generator
+                )
 
                 # Add noise to the latents according to the noise magnitude at each timestep
                 # (this is the forward diffusion process)
-                noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
+                noisy_latents, target = forward_diffusion_fn(
+                    latents, noise, timesteps, sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod, args.v_parameterization
+                )
 
                 # Predict the noise residual
-                noise_pred = unet(noisy_latents, timesteps, encoder_hidden_states).sample
-
-                if args.v_parameterization:
-                    # v-parameterization training
-                    target = noise_scheduler.get_velocity(latents, noise, timesteps)
-                else:
-                    target = noise
-
-                loss = torch.nn.functional.mse_loss(noise_pred.float(), target.float(), reduction="none")
-                loss = loss.mean([1, 2, 3])
-                
-                if args.min_snr_gamma:
-                  loss = apply_snr_weight(loss, timesteps, noise_scheduler, args.min_snr_gamma)
+                with accelerator.autocast():
+                    noise_pred = unet(noisy_latents, timesteps, encoder_hidden_states).sample
 
                 loss_weights = batch["loss_weights"]  # 各sampleごとのweight
-                loss = loss * loss_weights
+                if snr_weights is not None:
+                    loss_weights = loss_weights * snr_weights[timesteps]
 
-                loss = loss.mean()  # 平均なのでbatch_sizeで割る必要なし
+                loss = weighted_mse_loss_fn(noise_pred, target, loss_weights)
 
                 accelerator.backward(loss)
-                if accelerator.sync_gradients and args.max_grad_norm != 0.0:
-                    params_to_clip = text_encoder.get_input_embeddings().parameters()
-                    accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
 
-                optimizer.step()
-                lr_scheduler.step()
-                optimizer.zero_grad(set_to_none=True)
+                # 勾配を合計している間はoptimizerのstepとzero_gradを省く
+                if accelerator.sync_gradients:
+                    if args.max_grad_norm != 0.0:
+                        accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
 
-                # Let's make sure we don't update any embedding weights besides the newly added token
-                with torch.no_grad():
-                    unwrap_model(text_encoder).get_input_embeddings().weight[index_no_updates] = orig_embeds_params[
-                        index_no_updates
-                    ]
+                    optimizer.step()
+                    optimizer.zero_grad(set_to_none=True)
+
+                lr_scheduler.step()  # schedulerはmicro-stepごとに進める（get_scheduler_fixの前提）
+
+            loss_total += loss.detach()
 
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
                 progress_bar.update(1)
                 global_step += 1
+                current_step.value = global_step
 
                 train_util.sample_images(
                     accelerator, args, None, global_step, accelerator.device, vae, tokenizer, text_encoder, unet, prompt_replacement
                 )
 
-            current_loss = loss.detach().item()
-            if args.logging_dir is not None:
-                logs = {"loss": current_loss, "lr": float(lr_scheduler.get_last_lr()[0])}
-                if args.optimizer_type.lower() == "DAdaptation".lower():  # tracking d*lr value
-                    logs["lr/d*lr"] = (
-                        lr_scheduler.optimizers[0].param_groups[0]["d"] * lr_scheduler.optimizers[0].param_groups[0]["lr"]
-                    )
-                accelerator.log(logs, step=global_step)
-
-            loss_total += current_loss
-            avr_loss = loss_total / (step + 1)
-            logs = {"loss": avr_loss}  # , "lr": lr_scheduler.get_last_lr()[0]}
-            progress_bar.set_postfix(**logs)
+                # .item()は同期するので、optimizerのstepごとに必要な場合のみ読む
+                if args.logging_dir is not None:
+                    current_loss = loss.detach().item()
+                    logs = {"loss": current_loss, "lr": float(lr_scheduler.get_last_lr()[0])}
+                    if args.optimizer_type.lower() == "DAdaptation".lower():  # tracking d*lr value
+                        logs["lr/d*lr"] = (
+                            lr_scheduler.optimizers[0].param_groups[0]["d"] * lr_scheduler.optimizers[0].param_groups[0]["lr"]
+                        )
+                    accelerator.log(logs, step=global_step)
+
+                # progress barの更新は10stepごと
+                if not progress_bar.disable and global_step % 10 == 0:
+                    avr_loss = loss_total.item() / (step + 1)
+                    logs = {"loss": avr_loss}  # , "lr": lr_scheduler.get_last_lr()[0]}
+                    progress_bar.set_postfix(**logs, refresh=False)
 
             if global_step >= args.max_train_steps:
                 break
 
         if args.logging_dir is not None:
-            logs = {"loss/epoch": loss_total / len(train_dataloader)}
+            logs = {"loss/epoch": loss_total.item() / len(train_dataloader)}
             accelerator.log(logs, step=epoch + 1)
 
         accelerator.wait_for_everyone()
 
-        updated_embs = unwrap_model(text_encoder).get_input_embeddings().weight[token_ids].data.detach().clone()
+        updated_embs = trained_embeds.detach()
 
         if args.save_every_n_epochs is not None:
             model_name = train_util.DEFAULT_EPOCH_NAME if args.output_name is None else args.output_name
@@ -452,11 +518,19 @@ def train(args):
                 print(f"saving checkpoint: {ckpt_file}")
                 save_weights(ckpt_file, updated_embs, save_dtype)
                 if args.huggingface_repo_id is not None:
-                    huggingface_util.upload(args, ckpt_file, "/" + ckpt_name)
+                    if upload_executor is not None:
+                        future = upload_executor.submit(huggingface_util.upload, args, ckpt_file, "/" + ckpt_name, True)
+                        future.add_done_callback(report_upload_error)
+                        upload_futures[ckpt_file] = future
+                    else:
+                        huggingface_util.upload(args, ckpt_file, "/" + ckpt_name)
 
             def remove_old_func(old_epoch_no):
                 old_ckpt_name = train_util.EPOCH_FILE_NAME.format(model_name, old_epoch_no) + "." + args.save_model_as
                 old_ckpt_file = os.path.join(args.output_dir, old_ckpt_name)
+                pending_upload = upload_futures.pop(old_ckpt_file, None)
+                if pending_upload is not None:
+                    concurrent.futures.wait([pending_upload])  # アップロードが終わるまで待つ
                 if os.path.exists(old_ckpt_file):
                     print(f"removing old checkpoint: {old_ckpt_file}")
                     os.remove(old_ckpt_file)
@@ -480,10 +554,13 @@ def train(args):
     if args.save_state:
         train_util.save_state_on_train_end(args, accelerator)
 
-    updated_embs = text_encoder.get_input_embeddings().weight[token_ids].data.detach().clone()
+    updated_embs = trained_embeds.detach()
 
     del accelerator  # この後メモリを使うのでこれは消す
 
+    if upload_executor is not None:
+        upload_executor.shutdown(wait=True)
+
     if is_main_process:
         os.makedirs(args.output_dir, exist_ok=True)
 
@@ -499,14 +576,10 @@ def train(args):
 
 
 def save_weights(file, updated_embs, save_dtype):
+    # CPUへのコピーとcastを一度に行う（学習中のパラメータとメモリを共有しない）
+    updated_embs = updated_embs.detach().to("cpu", dtype=save_dtype or updated_embs.dtype, copy=True)
     state_dict = {"emb_params": updated_embs}
 
-    if save_dtype is not None:
-        for key in list(state_dict.keys()):
-            v = state_dict[key]
-            v = v.detach().clone().to("cpu").to(save_dtype)
-            state_dict[key] = v
-
     if os.path.splitext(file)[1] == ".safetensors":
         from safetensors.torch import save_file
 
@@ -515,6 +588,26 @@ def save_weights(file, updated_embs, save_dtype):
         torch.save(state_dict, file)  # can be loaded in Web UI
 
 
+class GeneratorState:
+    """
+    Wraps a torch.Generator with state_dict/load_state_dict for accelerator.register_for_checkpointing.
+    """
+
+    def __init__(self, generator):
+        self.generator = generator
+
+    def state_dict(self):
+        return {"rng_state": self.generator.get_state()}
+
+    def load_state_dict(self, state_dict):
+        self.generator.set_state(state_dict["rng_state"].cpu())
+
+
+def report_upload_error(future):
+    if future.exception() is not None:
+        print(f"failed to upload to huggingface / huggingfaceへのアップロードに失敗しました: {future.exception()}")
+
+
 def load_weights(file):
     if os.path.splitext(file)[1] == ".safetensors":
         from safetensors.torch import load_file
@@ -541,6 +634,49 @@ def load_weights(file):
     return emb
 
 
+def forward_diffusion(latents, noise, timesteps, sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod, v_parameterization):
+    """
+    Returns the noisy latents and the target of the prediction, same as noise_scheduler.add_noise and
+    noise_scheduler.get_velocity (for v-parameterization) but with the coefficients already on the device.
+    """
+    sqrt_alpha_prod = sqrt_alphas_cumprod[timesteps].view(-1, 1, 1, 1).to(latents.dtype)
+    sqrt_one_minus_alpha_prod = sqrt_one_minus_alphas_cumprod[timesteps].view(-1, 1, 1, 1).to(latents.dtype)
+    noisy_latents = sqrt_alpha_prod * latents + sqrt_one_minus_alpha_prod * noise
+
+    if v_parameterization:
+        target = sqrt_alpha_prod * noise - sqrt_one_minus_alpha_prod * latents
+    else:
+        target = noise
+    return noisy_latents, target
+
+
+def weighted_mse_loss(noise_pred, target, loss_weights):
+    # loss_weightsにはmin-SNRの重みも含まれる
+    loss = torch.nn.functional.mse_loss(noise_pred.float(), target.float(), reduction="none").mean([1, 2, 3])
+    return (loss * loss_weights).mean()  # 平均なのでbatch_sizeで割る必要なし
+
+
+def patch_token_embedding(embedding, token_ids):
+    """
+    Move the embeddings of the added tokens to a separate small parameter and patch the forward of the token embedding
+    to look them up there, so the optimizer and the gradient cover only (num_vectors_per_token, dim) instead of the whole vocabulary.
+    token_ids must be contiguous and at the end of the vocabulary.
+    """
+    token_id_start = token_ids[0]
+    # token_idsは連続しているのでsliceで取り出す
+    trained_embeds = torch.nn.Parameter(embedding.weight.data[token_id_start : token_id_start + len(token_ids)].clone())
+    embedding.register_parameter("trained_embeds", trained_embeds)  # move with the module by .to() and accelerator
+    embedding.weight.requires_grad_(False)
+
+    def forward(input_ids):
+        embeds = torch.nn.functional.embedding(input_ids, embedding.weight)
+        trained = torch.nn.functional.embedding((input_ids - token_id_start).clamp(min=0), embedding.trained_embeds)
+        return torch.where((input_ids >= token_id_start).unsqueeze(-1), trained, embeds)
+
+    embedding.forward = forward
+    return trained_embeds
+
+
 def setup_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
 
@@ -580,6 +716,22 @@ def setup_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="ignore caption and use default templates for stype / キャプションは使わずデフォルトのスタイル用テンプレートで学習する",
     )
+    parser.add_argument(
+        "--cache_latents_to_disk",
+        action="store_true",
+        help="cache latents (implies --cache_latents) and also save them to output_dir/.latents_cache to reuse in the next run / latentをキャッシュし（--cache_latentsを含む）、output_dir/.latents_cacheにも保存して次回以降の学習で再利用する",
+    )
+    parser.add_argument(
+        "--torch_compile",
+        action="store_true",
+        help="compile the forward diffusion and the loss with torch.compile (PyTorch 2.0 or later) / 拡散過程とlossの計算をtorch.compileでコンパイルする（PyTorch 2.0以降）",
+    )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=2,
+        help="number of batches loaded in advance by each DataLoader worker / DataLoaderの各ワーカーが先読みするバッチ数",
+    )
 
     return parser
 